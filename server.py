@@ -1,23 +1,34 @@
 import asyncio
-import json
 import os
+import inspect
 import logging
+import queue
+import re
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from urllib.parse import urlparse
 
+import orjson
 from hypercorn import Config
 from hypercorn.asyncio import serve
 from starlette.applications import Starlette
 from starlette.routing import Route, WebSocketRoute
-from starlette.responses import FileResponse, JSONResponse
+from starlette.responses import FileResponse, Response
 from starlette.websockets import WebSocketDisconnect
+from pycrdt import merge_updates
 
 try:
     from pycrdt_websocket import ASGIServer, WebsocketServer, YRoom
-    from pycrdt_websocket.ystore import FileYStore, YDocNotFound
+    from pycrdt_websocket.ystore import BaseYStore, FileYStore, YDocNotFound
 except ImportError:
     from pycrdt.websocket import ASGIServer, WebsocketServer, YRoom
-    from pycrdt.store import FileYStore, YDocNotFound
+    from pycrdt.store import BaseYStore, FileYStore, YDocNotFound
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,188 @@ LEAN_PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lea
 LEAN_FILE_PATH = os.path.join(LEAN_PROJECT_DIR, "src", "Scratch.lean")
 LEAN_PROJECT_URI = Path(LEAN_PROJECT_DIR).resolve().as_uri()
 LEAN_FILE_URI = Path(LEAN_FILE_PATH).resolve().as_uri()
+# /file-uri never changes at runtime, so serialize its payload once
+FILE_URI_PAYLOAD = orjson.dumps({"fileUri": LEAN_FILE_URI, "rootUri": LEAN_PROJECT_URI})
+
+# Seconds to wait for further edits before writing Scratch.lean to disk
+LEAN_FILE_WRITE_DEBOUNCE_SECONDS = 0.15
+
+# lake serve → browser: messages arriving within this window share one WS frame
+LSP_BATCH_WINDOW_SECONDS = 0.005
+LSP_BATCH_MAX_MESSAGES = 32
+# Messages read from lake serve but not yet sent before we stop reading stdout
+LSP_OUTGOING_QUEUE_SIZE = 4 * LSP_BATCH_MAX_MESSAGES
+
+# Only await stdin.drain() once this many bytes are queued for lake serve
+LSP_STDIN_DRAIN_THRESHOLD = 64 * 1024
+
+# LSP bodies at least this large are written without joining header + body
+LSP_SPLIT_WRITE_MIN_BYTES = 16 * 1024
+
+# Worker threads shared by all blocking file and subprocess work
+IO_THREAD_POOL_SIZE = 4
+
+# Upper bound on running `lake serve` processes (each is a memory-hungry Lean
+# server); sessions beyond it wait up to LEAN_SLOT_WAIT_SECONDS for a slot.
+LEAN_MAX_PROCS = int(os.environ.get("LEAN_MAX_PROCS", max(1, min(4, (os.cpu_count() or 2) // 2))))
+LEAN_SLOT_WAIT_SECONDS = 30
+
+# Block size for reading lake serve stderr into the log
+LAKE_STDERR_READ_SIZE = 4096
+
+# Idle `lake serve` processes kept ready so new sessions skip process startup
+LEAN_POOL_SIZE = 1
+
+# Seconds to buffer Yjs updates in memory before persisting them as one write
+YSTORE_THROTTLE_SECONDS = 2.0
+
+# Compact a room's update log once it is this many times its merged size
+YLOG_COMPACT_RATIO = 8
+
+
+# ---------------------------------------------------------------------------
+# Yjs persistence — append-only update log, written in coalesced bursts
+# ---------------------------------------------------------------------------
+class AppendYStore(BaseYStore):
+    """YStore kept as an append-only log of length-prefixed Yjs updates.
+
+    Each record is a little-endian uint32 length followed by the raw update.
+    The log is merged into one update when it is loaded, and rewritten as that
+    single record once it has grown much larger than the merged document;
+    this is checked on load and again as appends accumulate.
+    """
+
+    _RECORD_HEADER = struct.Struct("<I")
+
+    def __init__(self, path: str, metadata_callback=None, log=None):
+        self.path = path
+        self.metadata_callback = metadata_callback
+        self.log = log or logger
+        self._file = None
+        self._io_lock = asyncio.Lock()
+        self._log_size = 0  # Bytes in the log file
+        self._merged_size = 0  # Size of the merged document at the last check
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append(self, data: bytes):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab", buffering=64 * 1024)
+            self._log_size = self._file.tell()
+        self._file.write(self._RECORD_HEADER.pack(len(data)))
+        self._file.write(data)
+        self._file.flush()
+        self._log_size += self._RECORD_HEADER.size + len(data)
+        if not self._merged_size:
+            self._merged_size = self._log_size
+        elif self._log_size > YLOG_COMPACT_RATIO * self._merged_size:
+            self._load()  # Re-merges, compacting if the ratio still holds
+
+    def _rewrite(self, data: bytes):
+        self._close_file()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(self._RECORD_HEADER.pack(len(data)))
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _load(self) -> bytes | None:
+        try:
+            with open(self.path, "rb") as f:
+                log = f.read()
+        except FileNotFoundError:
+            return None
+
+        records: list[bytes] = []
+        offset = 0
+        header_size = self._RECORD_HEADER.size
+        while offset + header_size <= len(log):
+            (length,) = self._RECORD_HEADER.unpack_from(log, offset)
+            end = offset + header_size + length
+            if end > len(log):
+                break  # Torn write at the tail
+            records.append(log[offset + header_size:end])
+            offset = end
+
+        if offset < len(log):
+            self._close_file()
+            os.truncate(self.path, offset)
+        self._log_size = offset
+        if not records:
+            self._merged_size = 0
+            return None
+        merged = records[0] if len(records) == 1 else merge_updates(*records)
+        self._merged_size = header_size + len(merged)
+        if len(records) > 1 and offset > YLOG_COMPACT_RATIO * self._merged_size:
+            self._rewrite(merged)
+            self._log_size = self._merged_size
+        return merged
+
+    async def read(self):
+        async with self._io_lock:
+            merged = await asyncio.to_thread(self._load)
+        if merged is None:
+            raise YDocNotFound
+        yield merged, b"", 0.0
+
+    async def write(self, data: bytes) -> None:
+        async with self._io_lock:
+            await asyncio.to_thread(self._append, data)
+
+    async def close(self):
+        """Close the append handle; a later write reopens it."""
+        async with self._io_lock:
+            self._close_file()
+
+
+class ThrottledYStore(AppendYStore):
+    """AppendYStore that merges updates received within a throttle window."""
+
+    def __init__(self, *args, throttle: float = YSTORE_THROTTLE_SECONDS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.throttle = throttle
+        self._pending: list[bytes] = []
+        self._flush_task: asyncio.Task | None = None
+
+    async def write(self, data: bytes) -> None:
+        self._pending.append(data)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.throttle)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Persist all buffered updates as one merged update."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if not self._pending:
+            return
+        updates, self._pending = self._pending, []
+        merged = updates[0] if len(updates) == 1 else merge_updates(*updates)
+        try:
+            await super().write(merged)
+        except Exception:
+            logger.exception(f"Failed to persist Yjs updates to {self.path}")
+            # Keep them, ahead of anything buffered meanwhile, for the next flush
+            self._pending.insert(0, merged)
+
+    async def close(self):
+        await self.flush()
+        await super().close()
 
 
 # ---------------------------------------------------------------------------
@@ -36,7 +229,7 @@ LEAN_FILE_URI = Path(LEAN_FILE_PATH).resolve().as_uri()
 class Server(WebsocketServer):
     async def get_room(self, name: str) -> YRoom:
         if name not in self.rooms:
-            ystore = FileYStore(path=f"./data/{name}.ystore")
+            ystore = ThrottledYStore(path=f"./data/{name}.ylog")
             room = YRoom(ystore=ystore, ready=False)
             self.rooms[name] = room
 
@@ -47,18 +240,187 @@ class Server(WebsocketServer):
             try:
                 await room.ystore.apply_updates(room.ydoc)
             except YDocNotFound:
-                pass
+                await self._import_legacy_ystore(name, room)
             room.ready = True
 
         return room
 
+    async def _import_legacy_ystore(self, name: str, room: YRoom):
+        """Seed a room's update log from its old FileYStore file, if any."""
+        legacy_path = f"./data/{name}.ystore"
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            await FileYStore(path=legacy_path).apply_updates(room.ydoc)
+        except YDocNotFound:
+            return
+        await room.ystore.write(room.ydoc.get_update())
+        logger.info(f"Imported {legacy_path} into the update log for room {name}")
+
+    async def delete_room(self, *, name: str | None = None, room: YRoom | None = None):
+        # Persist buffered updates and release the log file before the room
+        # goes away; a reconnect then opens a fresh store on a settled file.
+        target = room if room is not None else self.rooms.get(name)
+        if target is not None and isinstance(target.ystore, ThrottledYStore):
+            await target.ystore.close()
+        result = super().delete_room(name=name, room=room)
+        if inspect.isawaitable(result):
+            await result
+
+    async def flush_ystores(self):
+        for room in list(self.rooms.values()):
+            if isinstance(room.ystore, ThrottledYStore):
+                await room.ystore.flush()
+
 
 # ---------------------------------------------------------------------------
 # LSP Process Manager — one `lake serve` per session
 # ---------------------------------------------------------------------------
+class _ThreadSpawnedProcess:
+    """asyncio.subprocess.Process look-alike wrapping a Popen started off-loop."""
+
+    def __init__(self, popen: subprocess.Popen, stdin: asyncio.StreamWriter,
+                 stdout: asyncio.StreamReader, stderr: asyncio.StreamReader):
+        self._popen = popen
+        self.pid = popen.pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @classmethod
+    async def attach(cls, popen: subprocess.Popen) -> "_ThreadSpawnedProcess":
+        loop = asyncio.get_running_loop()
+
+        async def reader(pipe) -> asyncio.StreamReader:
+            stream = asyncio.StreamReader()
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream), pipe)
+            return stream
+
+        stdout = await reader(popen.stdout)
+        stderr = await reader(popen.stderr)
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, popen.stdin)
+        stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+        return cls(popen, stdin, stdout, stderr)
+
+    @property
+    def returncode(self) -> int | None:
+        return self._popen.poll()
+
+    def terminate(self):
+        self._popen.terminate()
+
+    def kill(self):
+        self._popen.kill()
+
+    async def wait(self) -> int:
+        # Poll instead of parking a shared worker thread in Popen.wait()
+        delay = 0.005
+        while (returncode := self._popen.poll()) is None:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return returncode
+
+
 class LeanProcessManager:
-    def __init__(self):
+    def __init__(self, pool_size: int = LEAN_POOL_SIZE, max_procs: int = LEAN_MAX_PROCS):
         self.processes: dict[str, asyncio.subprocess.Process] = {}
+        # One slot per running lake serve (session or pooled); sessions queue
+        # for a free slot rather than piling more Lean servers onto the host.
+        self.max_procs = max_procs
+        self._slots = asyncio.Semaphore(max_procs)
+        # Idle, already-started processes handed to new sessions. Each one holds
+        # a full Lean server in memory, so keep the pool small.
+        self.pool_size = pool_size
+        self._pool: asyncio.Queue[asyncio.subprocess.Process] = asyncio.Queue()
+        self._refill_task: asyncio.Task | None = None
+
+    async def _start_one(self) -> asyncio.subprocess.Process:
+        if sys.platform == "win32":
+            # Proactor pipes need overlapped handles, which Popen does not create
+            return await asyncio.create_subprocess_exec(
+                "lake", "serve",
+                cwd=LEAN_PROJECT_DIR,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        # fork/exec can take several ms; do it in a worker thread so other
+        # sessions are not stalled, then attach the pipes to the event loop.
+        popen = await asyncio.to_thread(
+            subprocess.Popen,
+            ["lake", "serve"],
+            cwd=LEAN_PROJECT_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            return await _ThreadSpawnedProcess.attach(popen)
+        except BaseException:
+            popen.kill()
+            raise
+
+    def refill_pool(self):
+        """Start topping the warm pool back up in the background."""
+        if self.pool_size > 0 and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self._fill_pool())
+
+    async def _fill_pool(self):
+        # Never take a slot that a queued session is waiting for
+        while self._pool.qsize() < self.pool_size and not self._slots.locked():
+            await self._slots.acquire()
+            try:
+                proc = await self._start_one()
+            except Exception as e:
+                self._slots.release()
+                logger.error(f"Failed to pre-spawn lake serve: {e}")
+                return
+            self._pool.put_nowait(proc)
+            logger.info(f"Pre-spawned lake serve for warm pool (pid={proc.pid})")
+
+    def _take_pooled(self) -> asyncio.subprocess.Process | None:
+        while not self._pool.empty():
+            proc = self._pool.get_nowait()
+            if proc.returncode is None:
+                return proc
+            self._slots.release()
+        return None
+
+    async def _wait_for_pooled_or_slot(self) -> asyncio.subprocess.Process | None:
+        """Wait for a pooled process or a free slot, whichever comes first.
+
+        Returns the pooled process (which already holds a slot), or None once a
+        slot has been acquired for a fresh spawn. A warm-pool spawn in flight
+        when the session arrives lands in the pool without releasing a slot, so
+        waiting on the semaphore alone could time out next to an idle process.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LEAN_SLOT_WAIT_SECONDS
+        while True:
+            proc = self._take_pooled()
+            if proc is not None:
+                return proc
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                raise asyncio.TimeoutError
+            pooled = asyncio.create_task(self._pool.get())
+            slot = asyncio.create_task(self._slots.acquire())
+            completed = False
+            try:
+                await asyncio.wait((pooled, slot), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                completed = True
+            finally:
+                pooled.cancel()
+                slot.cancel()
+                await asyncio.wait((pooled, slot))
+                if not pooled.cancelled():
+                    self._pool.put_nowait(pooled.result())  # Picked up by _take_pooled
+                if not completed and not slot.cancelled():
+                    self._slots.release()
+            if not slot.cancelled():
+                if self._pool.empty():
+                    return None
+                self._slots.release()  # A pooled process arrived too; use it instead
 
     async def spawn(self, session_id: str) -> asyncio.subprocess.Process:
         if session_id in self.processes:
@@ -67,29 +429,48 @@ class LeanProcessManager:
                 return proc
             # Process died, remove it
             del self.processes[session_id]
+            self._slots.release()
 
-        proc = await asyncio.create_subprocess_exec(
-            "lake", "serve",
-            cwd=LEAN_PROJECT_DIR,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        proc = await self._wait_for_pooled_or_slot()
+        if proc is None:
+            try:
+                proc = await self._start_one()
+            except BaseException:
+                self._slots.release()
+                raise
+            logger.info(f"Spawned lake serve for session {session_id} (pid={proc.pid})")
+        else:
+            logger.info(f"Assigned pooled lake serve to session {session_id} (pid={proc.pid})")
         self.processes[session_id] = proc
-        logger.info(f"Spawned lake serve for session {session_id} (pid={proc.pid})")
+        self.refill_pool()
         return proc
 
-    async def kill(self, session_id: str):
-        proc = self.processes.pop(session_id, None)
-        if proc and proc.returncode is None:
+    @staticmethod
+    async def _terminate(proc: asyncio.subprocess.Process):
+        if proc.returncode is None:
             proc.terminate()
             try:
                 await asyncio.wait_for(proc.wait(), timeout=5)
             except asyncio.TimeoutError:
                 proc.kill()
+
+    async def kill(self, session_id: str):
+        proc = self.processes.pop(session_id, None)
+        if proc is None:
+            return
+        if proc.returncode is None:
+            await self._terminate(proc)
             logger.info(f"Killed lake serve for session {session_id}")
+        self._slots.release()
+        self.refill_pool()
 
     async def kill_all(self):
+        self.pool_size = 0  # Stop the pool from refilling
+        if self._refill_task is not None:
+            await self._refill_task  # Let an in-flight spawn land in the pool
+        while not self._pool.empty():
+            await self._terminate(self._pool.get_nowait())
+            self._slots.release()
         for sid in list(self.processes):
             await self.kill(sid)
 
@@ -97,30 +478,43 @@ class LeanProcessManager:
 # ---------------------------------------------------------------------------
 # LSP Content-Length framing helpers
 # ---------------------------------------------------------------------------
-def encode_lsp_message(obj: dict) -> bytes:
-    body = json.dumps(obj).encode("utf-8")
-    header = f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
-    return header + body
+def encode_lsp_message(obj: dict | bytes) -> tuple[bytes, bytes]:
+    """Return the (header, body) byte strings for one framed LSP message.
+
+    `obj` is either a message dict or an already-serialized JSON body.
+    """
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return b"Content-Length: %d\r\n\r\n" % len(body), body
+
+
+def write_lsp_message(writer: asyncio.StreamWriter, obj: dict | bytes):
+    """Queue one framed LSP message on `writer` without copying large bodies."""
+    header, body = encode_lsp_message(obj)
+    # Pipe transports implement writelines() as b"".join(...), so large bodies
+    # are written separately (one extra syscall, no copy of the body).
+    if len(body) < LSP_SPLIT_WRITE_MIN_BYTES:
+        writer.write(header + body)
+    else:
+        writer.write(header)
+        writer.write(body)
+
+
+_CONTENT_LENGTH_RE = re.compile(rb"(?i)content-length:\s*(\d+)")
 
 
 async def read_lsp_message(stdout: asyncio.StreamReader) -> dict | None:
     """Read one LSP message from stdout using Content-Length framing."""
-    content_length = -1
-    while True:
-        line = await stdout.readline()
-        if not line:
-            return None  # EOF
-        line_str = line.decode("ascii", errors="replace").strip()
-        if not line_str:
-            break  # empty line = end of headers
-        if line_str.lower().startswith("content-length:"):
-            content_length = int(line_str.split(":", 1)[1].strip())
-
-    if content_length < 0:
+    try:
+        header = await stdout.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None  # EOF
+
+    m = _CONTENT_LENGTH_RE.search(header)
+    if m is None:
         return None
 
-    body = await stdout.readexactly(content_length)
-    return json.loads(body)
+    body = await stdout.readexactly(int(m.group(1)))
+    return orjson.loads(body)
 
 
 # ---------------------------------------------------------------------------
@@ -129,16 +523,94 @@ async def read_lsp_message(stdout: asyncio.StreamReader) -> dict | None:
 lean_manager = LeanProcessManager()
 
 
-def _write_lean_file(content: str):
-    """Write editor content to the Lean source file on disk."""
+_pending_text: str | None = None
+_write_task: asyncio.Task | None = None
+# Hash of the newest text handed to the writer (pending, in flight or written)
+_last_text_hash: int | None = None
+# Hash of the text currently on disk, as far as this process knows
+_written_text_hash: int | None = None
+
+
+def _do_write(content: str):
+    """Atomically replace the Lean source file (runs in a worker thread)."""
+    # Encode once and write raw bytes: no TextIOWrapper, no newline translation
+    data = memoryview(content.encode("utf-8"))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(LEAN_FILE_PATH), prefix=".Scratch.", suffix=".tmp"
+    )
     try:
-        with open(LEAN_FILE_PATH, "w", encoding="utf-8") as f:
-            f.write(content)
-    except Exception as e:
-        logger.error(f"Failed to write {LEAN_FILE_PATH}: {e}")
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, LEAN_FILE_PATH)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def _debounced_write():
+    """Write the latest pending content once edits have settled."""
+    global _pending_text, _write_task, _last_text_hash, _written_text_hash
+    try:
+        while _pending_text is not None:
+            await asyncio.sleep(LEAN_FILE_WRITE_DEBOUNCE_SECONDS)
+            content, _pending_text = _pending_text, None
+            h = hash(content)
+            if h == _written_text_hash:
+                continue  # Edits came back to what is already on disk
+            try:
+                await asyncio.to_thread(_do_write, content)
+            except Exception as e:
+                logger.error(f"Failed to write {LEAN_FILE_PATH}: {e}")
+                if _pending_text is None:
+                    _last_text_hash = None  # Let the next identical edit retry
+            else:
+                _written_text_hash = h
+    finally:
+        _write_task = None
+
+
+def _write_lean_file(content: str):
+    """Schedule editor content to be written to the Lean source file on disk."""
+    global _pending_text, _write_task, _last_text_hash
+    h = hash(content)
+    if h == _last_text_hash:
+        return  # Same as the text already queued, being written, or on disk
+    _pending_text = content
+    _last_text_hash = h
+    if _write_task is None:
+        _write_task = asyncio.create_task(_debounced_write())
+
+
+async def flush_lean_file():
+    """Wait for any pending Lean source write to reach disk."""
+    if _write_task is not None:
+        await _write_task
+
+
+# LSP methods whose params carry the full document text (full-document sync:
+# for didChange the last content change holds the complete text).
+_TEXT_EXTRACTORS = {
+    "textDocument/didOpen": lambda params: params["textDocument"]["text"],
+    "textDocument/didChange": lambda params: params["contentChanges"][-1]["text"],
+}
 
 
 def _is_valid_file_uri(value: object) -> bool:
+    """Cheap check for document URIs, which are validated on every message."""
+    return (
+        isinstance(value, str)
+        and value.startswith("file://")
+        and len(value) > 7
+        and "\x00" not in value
+    )
+
+
+def _is_valid_root_uri(value: object) -> bool:
+    """Full check for the workspace root URI (sent once, in `initialize`)."""
     if not isinstance(value, str):
         return False
     parsed = urlparse(value)
@@ -147,6 +619,33 @@ def _is_valid_file_uri(value: object) -> bool:
     return bool(parsed.path)
 
 
+_METHODS_REQUIRING_DOC_URI: frozenset[str] = frozenset({
+    "textDocument/didOpen",
+    "textDocument/didChange",
+    "textDocument/hover",
+    "textDocument/completion",
+    "$/lean/plainGoal",
+    "$/lean/plainTermGoal",
+})
+
+
+def _needs_inspection(data: str) -> bool:
+    """Whether a raw client frame must be parsed before forwarding.
+
+    Only messages carrying a document URI, the workspace root (`initialize`)
+    or a `$/lean/...` method (which must carry a document URI) are validated
+    or intercepted. Escapes (`\\u0074`, `\\/`) could hide any of these, so
+    frames containing a backslash are always parsed. Frames that skip parsing
+    are not checked for valid JSON; lake serve reports malformed ones itself.
+    """
+    return (
+        "textDocument" in data
+        or "initialize" in data
+        or "$/lean/" in data
+        or "\\" in data
+    )
+
+
 def _validate_lsp_message_uris(msg: dict) -> list[str]:
     """Validate URI fields in LSP payloads before forwarding to Lean."""
     errors: list[str] = []
@@ -158,20 +657,12 @@ def _validate_lsp_message_uris(msg: dict) -> list[str]:
 
     if method == "initialize":
         root_uri = params.get("rootUri")
-        if not _is_valid_file_uri(root_uri):
+        if not _is_valid_root_uri(root_uri):
             errors.append(f"initialize.params.rootUri={root_uri!r}")
 
     text_document = params.get("textDocument")
     uri = text_document.get("uri") if isinstance(text_document, dict) else None
-    methods_requiring_doc_uri = {
-        "textDocument/didOpen",
-        "textDocument/didChange",
-        "textDocument/hover",
-        "textDocument/completion",
-        "$/lean/plainGoal",
-        "$/lean/plainTermGoal",
-    }
-    if method in methods_requiring_doc_uri and not _is_valid_file_uri(uri):
+    if method in _METHODS_REQUIRING_DOC_URI and not _is_valid_file_uri(uri):
         errors.append(f"{method}.params.textDocument.uri={uri!r}")
     elif uri is not None and not _is_valid_file_uri(uri):
         errors.append(f"{method}.params.textDocument.uri={uri!r}")
@@ -190,10 +681,7 @@ def create_app(ws_server: Server):
         return FileResponse(os.path.join(base_dir, "index.html"))
 
     async def file_uri(request):
-        return JSONResponse({
-            "fileUri": LEAN_FILE_URI,
-            "rootUri": LEAN_PROJECT_URI,
-        })
+        return Response(FILE_URI_PAYLOAD, media_type="application/json")
 
     async def yjs_ws_handler(websocket):
         scope = websocket.scope
@@ -205,6 +693,10 @@ def create_app(ws_server: Server):
 
         try:
             proc = await lean_manager.spawn(session_id)
+        except asyncio.TimeoutError:
+            logger.warning(f"No free lake serve slot for session {session_id}")
+            await websocket.close(code=1013, reason="server busy")
+            return
         except Exception as e:
             logger.error(f"Failed to spawn lake serve: {e}")
             await websocket.close(code=1011, reason=str(e))
@@ -215,56 +707,96 @@ def create_app(ws_server: Server):
             try:
                 while True:
                     data = await websocket.receive_text()
-                    msg = json.loads(data)
-                    uri_errors = _validate_lsp_message_uris(msg)
-                    if uri_errors:
-                        logger.error(
-                            "Rejecting invalid LSP payload (session=%s, errors=%s, payload=%s)",
-                            session_id,
-                            "; ".join(uri_errors),
-                            json.dumps(msg, ensure_ascii=False),
-                        )
-                        await websocket.close(code=1011, reason="Invalid LSP URI")
-                        return
-                    # Intercept didOpen / didChange to sync content to disk
-                    method = msg.get("method", "")
-                    if method == "textDocument/didOpen":
-                        text = msg.get("params", {}).get("textDocument", {}).get("text")
-                        if text is not None:
-                            _write_lean_file(text)
-                    elif method == "textDocument/didChange":
-                        changes = msg.get("params", {}).get("contentChanges", [])
-                        if changes:
-                            # Full-document sync: take the last full text
-                            text = changes[-1].get("text")
-                            if text is not None:
+                    if not _needs_inspection(data):
+                        # Nothing to validate or intercept: forward the frame as-is
+                        write_lsp_message(proc.stdin, data.encode("utf-8"))
+                    else:
+                        msg = orjson.loads(data)
+                        uri_errors = _validate_lsp_message_uris(msg)
+                        if uri_errors:
+                            logger.error(
+                                "Rejecting invalid LSP payload (session=%s, errors=%s, payload=%s)",
+                                session_id,
+                                "; ".join(uri_errors),
+                                orjson.dumps(msg).decode(),
+                            )
+                            await websocket.close(code=1011, reason="Invalid LSP URI")
+                            return
+                        # Intercept didOpen / didChange to sync content to disk
+                        extract_text = _TEXT_EXTRACTORS.get(msg.get("method"))
+                        if extract_text is not None:
+                            try:
+                                text = extract_text(msg["params"])
+                            except (KeyError, IndexError, TypeError):
+                                text = None
+                            if isinstance(text, str):
                                 _write_lean_file(text)
-                    proc.stdin.write(encode_lsp_message(msg))
-                    await proc.stdin.drain()
+                        write_lsp_message(proc.stdin, msg)
+                    # Writes normally go straight into the pipe; only yield to
+                    # flow control once a real backlog has built up.
+                    if proc.stdin.transport.get_write_buffer_size() > LSP_STDIN_DRAIN_THRESHOLD:
+                        await proc.stdin.drain()
             except (WebSocketDisconnect, RuntimeError):
                 pass
             except Exception:
                 logger.exception("Unexpected error forwarding WS -> lake stdin (session=%s)", session_id)
 
         async def stdout_to_ws():
-            """Forward lake serve stdout → WebSocket."""
+            """Forward lake serve stdout → WebSocket, batching bursts into one frame."""
+            loop = asyncio.get_running_loop()
+            # Bounded so a slow browser makes us stop reading lake serve output
+            outgoing: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=LSP_OUTGOING_QUEUE_SIZE)
+
+            async def read_stdout():
+                try:
+                    while (msg := await read_lsp_message(proc.stdout)) is not None:
+                        await outgoing.put(msg)
+                except Exception:
+                    logger.exception("Failed to read LSP message from lake stdout (session=%s)", session_id)
+                await outgoing.put(None)  # EOF / error: stop the sender
+
+            reader = asyncio.create_task(read_stdout())
             try:
-                while True:
-                    msg = await read_lsp_message(proc.stdout)
-                    if msg is None:
-                        break
-                    await websocket.send_text(json.dumps(msg))
+                while (msg := await outgoing.get()) is not None:
+                    batch = [msg]
+                    deadline = loop.time() + LSP_BATCH_WINDOW_SECONDS
+                    while len(batch) < LSP_BATCH_MAX_MESSAGES:
+                        try:
+                            msg = await asyncio.wait_for(outgoing.get(), deadline - loop.time())
+                        except asyncio.TimeoutError:
+                            break
+                        if msg is None:
+                            outgoing.put_nowait(None)  # Reader is done; send what we have, then stop
+                            break
+                        batch.append(msg)
+                    if len(batch) == 1:
+                        await websocket.send_text(orjson.dumps(batch[0]).decode())
+                    else:
+                        await websocket.send_text(orjson.dumps({"batch": batch}).decode())
             except (WebSocketDisconnect, RuntimeError, ConnectionError):
                 pass
+            finally:
+                reader.cancel()
 
         async def log_stderr():
-            """Log stderr from lake serve."""
+            """Log stderr from lake serve, one record per block of complete lines."""
+            prefix = f"[lake-{session_id}] "
+
+            def emit(data: bytes):
+                lines = data.decode(errors="replace").splitlines()
+                logger.info("\n".join(prefix + line for line in lines))
+
+            partial = b""
             try:
-                while True:
-                    line = await proc.stderr.readline()
-                    if not line:
-                        break
-                    logger.info(f"[lake-{session_id}] {line.decode(errors='replace').rstrip()}")
+                while chunk := await proc.stderr.read(LAKE_STDERR_READ_SIZE):
+                    complete, sep, partial = (partial + chunk).rpartition(b"\n")
+                    if sep:
+                        emit(complete)
+                    if len(partial) >= LAKE_STDERR_READ_SIZE:
+                        emit(partial)  # Overlong line: don't buffer it forever
+                        partial = b""
+                if partial:
+                    emit(partial)
             except Exception:
                 pass
 
@@ -301,9 +833,23 @@ def create_app(ws_server: Server):
 # Main
 # ---------------------------------------------------------------------------
 async def main():
-    import argparse
+    # Records are queued by the event loop and written out by a listener thread
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_listener = QueueListener(log_queue, log_handler)
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+
+    log_listener.start()
+    try:
+        await run_server()
+    finally:
+        # Writes out everything still queued, even after an early exit
+        log_listener.stop()
 
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+async def run_server():
+    import argparse
 
     parser = argparse.ArgumentParser(description="Lean 4 Collaborative Editor Server")
     parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
@@ -319,25 +865,39 @@ async def main():
     config.bind = [f"{args.host}:{args.port}"]
 
     print(f"Lean project dir: {LEAN_PROJECT_DIR}")
-    print(
-        "Startup /file-uri payload:",
-        json.dumps(
-            {
-                "fileUri": LEAN_FILE_URI,
-                "rootUri": LEAN_PROJECT_URI,
-            },
-            ensure_ascii=False,
-        ),
-    )
+    print("Startup /file-uri payload:", FILE_URI_PAYLOAD.decode())
     print(f"Server running at: http://{args.host}:{args.port}")
     print(f"Yjs WebSocket:     ws://{args.host}:{args.port}/yjs/{{room}}")
     print(f"LSP WebSocket:     ws://{args.host}:{args.port}/lsp/{{session_id}}")
 
+    loop = asyncio.get_running_loop()
+    # One bounded pool for all blocking work (file writes, process spawns) so a
+    # burst of new sessions cannot oversubscribe threads.
+    executor = ThreadPoolExecutor(max_workers=IO_THREAD_POOL_SIZE, thread_name_prefix="lean-io")
+    loop.set_default_executor(executor)
+
+    # Mirror hypercorn's default shutdown signals, but drive them through our
+    # own `stop` event so this function decides when serving ends.
+    stop = asyncio.Event()
+    signals = [signal.SIGINT, signal.SIGTERM]
+    if hasattr(signal, "SIGBREAK"):
+        signals.append(signal.SIGBREAK)
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows event loops lack add_signal_handler
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+
     async with server:
+        lean_manager.refill_pool()
         try:
-            await serve(app, config, mode="asgi")
+            await serve(app, config, mode="asgi", shutdown_trigger=stop.wait)
         finally:
+            await server.flush_ystores()
+            await flush_lean_file()
             await lean_manager.kill_all()
+            executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":